@@ -1,10 +1,17 @@
 #!/usr/bin/env python
 import os
 import re
+import sys
 import struct
+import subprocess
 import socket
-import select
 import platform
+import time
+import traceback
+import threading
+import functools
+import collections
+import asyncio
 
 """
 NAT-PMP client library
@@ -13,7 +20,6 @@ Provides functions to interact with NAT-PMP gateways implementing version 0
 of the NAT-PMP draft specification.
 
 This version does not completely implement the draft standard.
-* It does not provide functionality to listen for address change packets. 
 * It does not have a proper request queuing system, meaning that
 multiple requests may be issued in parallel, against spec recommendations.
 
@@ -52,6 +58,8 @@ POSSIBILITY OF SUCH DAMAGE."""
 __author__ = "Yiming Liu <http://www.yimingliu.com/>"
 
 NATPMP_PORT = 5351
+NATPMP_CLIENT_PORT = 5350  # address change announcements are sent here
+NATPMP_MULTICAST_ADDR = "224.0.0.1"
 
 NATPMP_RESERVED_VAL = 0
 
@@ -98,6 +106,23 @@ NATPMP_ERROR_DICT = {
                                             "manually."
               }
 
+# precompiled wire formats for requests and responses
+_REQ_BASE = struct.Struct('!BB')
+_REQ_PORTMAP = struct.Struct('!BBHHHI')
+_RESP_HEADER = struct.Struct('!BBHI')
+_RESP_ADDR = struct.Struct('!BBHII')
+_RESP_PORTMAP = struct.Struct('!BBHIHHI')
+_IP_STRUCT = struct.Struct('!I')
+# full response size by response opcode
+_RESP_SIZES = {128: _RESP_ADDR.size,
+               128 + NATPMP_PROTOCOL_UDP: _RESP_PORTMAP.size,
+               128 + NATPMP_PROTOCOL_TCP: _RESP_PORTMAP.size}
+
+# precompiled patterns for scraping the default gateway out of netstat -rn
+_RE_GW_POSIX = re.compile(r'(?:default|0\.0\.0\.0|::/0)\s+([\w\.:]+)\s+.*UG')
+_RE_GW_NT_WIN7 = re.compile(".*?0.0.0.0[ ]+0.0.0.0[ ]+(.*?)[ ]+?.*?\n")
+_RE_GW_NT_OLD = re.compile(".*?Default Gateway:[ ]+(.*?)\n")
+
 
 class NATPMPRequest(object):
     """Represents a basic NAT-PMP request.  This currently consists of the
@@ -105,6 +130,7 @@ class NATPMPRequest(object):
        
        Other requests are derived from NATPMPRequest.
     """
+    __slots__ = ('version', 'opcode')
     initial_timeout = 0.250  # seconds
 
     def __init__(self, version, opcode):
@@ -113,13 +139,15 @@ class NATPMPRequest(object):
 
     def toBytes(self):
         """Converts the request object to a byte string."""
-        return struct.pack('!BB', self.version, self.opcode)
+        return _REQ_BASE.pack(self.version, self.opcode)
 
 
 class PublicAddressRequest(NATPMPRequest):
     """Represents a NAT-PMP request to the local gateway for a public address.
        As per the specification, this is a generic request with the opcode = 0.
     """
+    __slots__ = ()
+
     def __init__(self, version=0):
         NATPMPRequest.__init__(self, version, 0)
 
@@ -130,6 +158,8 @@ class PortMapRequest(NATPMPRequest):
        the fields private_port, public_port, and lifetime.  The first two
        are 2-byte unsigned shorts, and the last is a 4-byte unsigned integer.
     """
+    __slots__ = ('private_port', 'public_port', 'lifetime')
+
     def __init__(self, protocol, private_port, public_port, lifetime=3600,
                  version=0):
         NATPMPRequest.__init__(self, version, protocol)
@@ -138,10 +168,9 @@ class PortMapRequest(NATPMPRequest):
         self.lifetime = lifetime
 
     def toBytes(self):
-        s = NATPMPRequest.toBytes(self) +\
-            struct.pack('!HHHI', NATPMP_RESERVED_VAL, self.private_port
-                        , self.public_port, self.lifetime)
-        return s
+        return _REQ_PORTMAP.pack(self.version, self.opcode,
+                                 NATPMP_RESERVED_VAL, self.private_port,
+                                 self.public_port, self.lifetime)
 
 
 class NATPMPResponse(object):
@@ -151,6 +180,8 @@ class NATPMPResponse(object):
        specification, the opcode is offset by 128 from the opcode of
        the original request.
     """
+    __slots__ = ('version', 'opcode', 'result', 'sec_since_epoch')
+
     def __init__(self, version, opcode, result, sec_since_epoch):
         self.version = version
         self.opcode = opcode
@@ -161,10 +192,8 @@ class NATPMPResponse(object):
         return self.result == NATPMP_RESULT_SUCCESS
         
     def __str__(self):
-        return "NATPMPResponse(%d, %d, %d, $d)".format(self.version,
-                                                       self.opcode,
-                                                       self.result,
-                                                       self.sec_since_epoch)
+        return (f"NATPMPResponse({self.version}, {self.opcode}, "
+                f"{self.result}, {self.sec_since_epoch})")
 
 
 class PublicAddressResponse(NATPMPResponse):
@@ -172,24 +201,33 @@ class PublicAddressResponse(NATPMPResponse):
        public-address request.  It has one additional 4-byte field
        containing the IP returned.
        
-       The member variable ip contains the Python-friendly string form, while
-       ip_int contains the same in the original 4-byte unsigned int.
+       The property ip contains the Python-friendly string form, formatted
+       on first access, while ip_int contains the same in the original
+       4-byte unsigned int.
+
+       An error response consisting of just the 8-byte header is accepted,
+       with ip_int set to 0.
     """
+    __slots__ = ('ip_int', '_ip')
+
     def __init__(self, data):
-        if len(data) > 12:
-            data = data[:12]
+        if len(data) < _RESP_ADDR.size:
+            data = data.ljust(_RESP_ADDR.size, b"\0")  # header-only error
         version, opcode, result, sec_since_epoch, self.ip_int =\
-            struct.unpack("!BBHII", data)
+            _RESP_ADDR.unpack_from(data)
         NATPMPResponse.__init__(self, version, opcode, result, sec_since_epoch)
-        self.ip = socket.inet_ntoa(data[8:8+4])
-        # self.ip  = socket.inet_ntoa(self.ip_bytes)
+        self._ip = None
+
+    @property
+    def ip(self):
+        if self._ip is None:
+            self._ip = socket.inet_ntoa(_IP_STRUCT.pack(self.ip_int))
+        return self._ip
 
     def __str__(self):
-        return "PublicAddressResponse: version %d, opcode %d (%d)," \
-               " result %d, ssec %d, ip %s".format(self.version, self.opcode,
-                                                   self.result,
-                                                   self.sec_since_epoch,
-                                                   self.ip)
+        return (f"PublicAddressResponse: version {self.version}, "
+                f"opcode {self.opcode}, result {self.result}, "
+                f"ssec {self.sec_since_epoch}, ip {self.ip}")
 
 
 class PortMapResponse(NATPMPResponse):
@@ -199,22 +237,31 @@ class PortMapResponse(NATPMPResponse):
        NAT-PMP headers.  Note that the port mapping assigned is
        NOT NECESSARILY the port requested (see the specification
        for details).
+
+       An error response consisting of just the 8-byte header is accepted,
+       with the ports and lifetime set to 0.
     """
+    __slots__ = ('private_port', 'public_port', 'lifetime')
+
     def __init__(self, data):
-        if len(data) > 16:
-            data = data[:16]
+        if len(data) < _RESP_PORTMAP.size:
+            data = data.ljust(_RESP_PORTMAP.size, b"\0")  # header-only error
         version, opcode, result, sec_since_epoch, self.private_port,\
-            self.public_port, self.lifetime = struct.unpack('!BBHIHHI', data)
+            self.public_port, self.lifetime = _RESP_PORTMAP.unpack_from(data)
         NATPMPResponse.__init__(self, version, opcode, result, sec_since_epoch)
     
     def __str__(self):
-        msg = "PortMapResponse: version %d, opcode %d (%d),"
-        msg += " result %d, ssec %d, private_port %d, public port %d,"
-        msg += " lifetime %d"
+        return (f"PortMapResponse: version {self.version}, "
+                f"opcode {self.opcode}, result {self.result}, "
+                f"ssec {self.sec_since_epoch}, "
+                f"private_port {self.private_port}, "
+                f"public port {self.public_port}, lifetime {self.lifetime}")
+
 
-        return msg % (self.version, self.opcode, self.opcode, self.result,
-                      self.sec_since_epoch, self.private_port, self.public_port,
-                      self.lifetime)
+# lightweight form of PortMapResponse returned by map_port_raw()
+PortMapResult = collections.namedtuple('PortMapResult',
+                                       'version opcode result sec_since_epoch '
+                                       'private_port public_port lifetime')
 
 
 class NATPMPError(Exception):
@@ -238,40 +285,123 @@ class NATPMPUnsupportedError(NATPMPError):
     pass
 
 
+class _GatewaySocketCache(threading.local):
+    """Per-thread map of gateway IP to an open gateway socket."""
+    def __init__(self):
+        self.sockets = {}
+
+
+_gateway_sockets = _GatewaySocketCache()
+
+
+def _get_gateway_linux():
+    """Reads the default IPv4 gateway from the kernel routing table in
+       /proc/net/route.  Returns None if no default route is found.
+    """
+    rtf_up_gateway = 0x1 | 0x2  # RTF_UP | RTF_GATEWAY
+    try:
+        with open('/proc/net/route') as route_table:
+            next(route_table)  # skip the header
+            for line in route_table:
+                fields = line.split()
+                if len(fields) < 4 or fields[1] != '00000000':
+                    continue
+                if int(fields[3], 16) & rtf_up_gateway == rtf_up_gateway:
+                    # addresses are hex in host byte order
+                    return socket.inet_ntoa(struct.pack('=I',
+                                                        int(fields[2], 16)))
+    except (IOError, OSError, ValueError, StopIteration):
+        pass
+    return None
+
+
+def _get_gateway_windows():
+    """Asks iphlpapi.GetBestRoute() for the next hop towards 0.0.0.0.
+       Returns None if no default route is found.
+    """
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class MIB_IPFORWARDROW(ctypes.Structure):
+            _fields_ = [(name, wintypes.DWORD) for name in (
+                'dwForwardDest', 'dwForwardMask', 'dwForwardPolicy',
+                'dwForwardNextHop', 'dwForwardIfIndex', 'dwForwardType',
+                'dwForwardProto', 'dwForwardAge', 'dwForwardNextHopAS',
+                'dwForwardMetric1', 'dwForwardMetric2', 'dwForwardMetric3',
+                'dwForwardMetric4', 'dwForwardMetric5')]
+
+        row = MIB_IPFORWARDROW()
+        if ctypes.windll.iphlpapi.GetBestRoute(0, 0, ctypes.byref(row)) != 0:
+            return None
+    except (ImportError, AttributeError, OSError):
+        return None
+    if not row.dwForwardNextHop:
+        return None
+    # the DWORD holds the address in network byte order
+    return socket.inet_ntoa(struct.pack('=I', row.dwForwardNextHop))
+
+
+def _get_gateway_netstat():
+    """Scrapes the output of netstat -rn for the default gateway."""
+    if os.name == "posix":
+        pattern = _RE_GW_POSIX
+    elif os.name == "nt":
+        if platform.version().startswith("6.1"):
+            pattern = _RE_GW_NT_WIN7
+        else:
+            pattern = _RE_GW_NT_OLD
+    try:
+        system_out = subprocess.run(['netstat', '-rn'], capture_output=True,
+                                    text=True).stdout
+    except OSError:
+        system_out = ""
+    if not system_out:
+        raise NATPMPNetworkError(NATPMP_GATEWAY_CANNOT_FIND,
+                                 error_str(NATPMP_GATEWAY_CANNOT_FIND))
+    match = pattern.search(system_out)
+    if not match:
+        raise NATPMPNetworkError(NATPMP_GATEWAY_CANNOT_FIND,
+                                 error_str(NATPMP_GATEWAY_CANNOT_FIND))
+    addr = match.groups()[0].strip()
+    return addr
+
+
+@functools.lru_cache(maxsize=1)
 def get_gateway_addr():
-    """Use netifaces to get the gateway address, if we can't import it then
-       fall back to a hack to obtain the current gateway automatically, since
-       Python has no interface to sysctl().
+    """Use netifaces to get the gateway address.  If we can't import it,
+       query the routing table directly (/proc/net/route on Linux,
+       GetBestRoute() on Windows), and as a last resort fall back to a hack
+       scraping netstat, since Python has no interface to sysctl().
 
        This may or may not be the gateway we should be contacting.
        It does not guarantee correct results.
 
-       This function requires the presence of netstat on the path on POSIX
-    and NT.
+       The netstat fallback requires the presence of netstat on the path.
+
+       The result is cached for the lifetime of the process.  Call
+       invalidate_gateway_cache() if the network configuration changes.
     """
     try:
         import netifaces
         return netifaces.gateways()["default"][netifaces.AF_INET][0]
     except ImportError:
-        shell_command = 'netstat -rn'
-        if os.name == "posix":
-            pattern = \
-                re.compile('(?:default|0\.0\.0\.0|::/0)\s+([\w\.:]+)\s+.*UG')
-        elif os.name == "nt":
-            if platform.version().startswith("6.1"):
-                pattern = re.compile(".*?0.0.0.0[ ]+0.0.0.0[ ]+(.*?)[ ]+?.*?\n")
-            else:
-                pattern = re.compile(".*?Default Gateway:[ ]+(.*?)\n")
-        system_out = os.popen(shell_command, 'r').read()
-        if not system_out:
-            raise NATPMPNetworkError(NATPMP_GATEWAY_CANNOT_FIND,
-                                     error_str(NATPMP_GATEWAY_CANNOT_FIND))
-        match = pattern.search(system_out)
-        if not match:
-            raise NATPMPNetworkError(NATPMP_GATEWAY_CANNOT_FIND,
-                                     error_str(NATPMP_GATEWAY_CANNOT_FIND))
-        addr = match.groups()[0].strip()
+        pass
+    addr = None
+    if sys.platform.startswith("linux"):
+        addr = _get_gateway_linux()
+    elif sys.platform == "win32":
+        addr = _get_gateway_windows()
+    if addr:
         return addr
+    return _get_gateway_netstat()
+
+
+def invalidate_gateway_cache():
+    """Forgets the gateway address cached by get_gateway_addr(), forcing
+       the next call to detect it again.
+    """
+    get_gateway_addr.cache_clear()
 
 
 def error_str(result_code):
@@ -300,6 +430,48 @@ def get_gateway_socket(gateway):
     return response_socket
 
 
+def _get_cached_gateway_socket(gateway):
+    """Returns the gateway socket for gateway held by the current thread,
+       opening one with get_gateway_socket() if necessary.  A reused
+       socket is drained first, so that duplicate replies to an earlier
+       retransmitted request are not mistaken for the next response.
+    """
+    gateway_socket = _gateway_sockets.sockets.get(gateway)
+    if gateway_socket is not None:
+        try:
+            _drain_gateway_socket(gateway_socket)
+        except OSError:
+            # the socket is unusable, replace it with a fresh one
+            _close_cached_gateway_socket(gateway)
+            gateway_socket = None
+    if gateway_socket is None:
+        gateway_socket = get_gateway_socket(gateway)
+        _gateway_sockets.sockets[gateway] = gateway_socket
+    return gateway_socket
+
+
+def _drain_gateway_socket(gateway_socket):
+    """Discards any datagrams and errors queued on gateway_socket.
+       Raises OSError if the socket reports anything but a queued
+       ICMP port unreachable error.
+    """
+    gateway_socket.setblocking(False)
+    while True:
+        try:
+            gateway_socket.recv(16)
+        except BlockingIOError:
+            return
+        except ConnectionRefusedError:
+            pass  # reported once per ICMP port unreachable
+
+
+def _close_cached_gateway_socket(gateway):
+    """Closes and forgets the current thread's socket for gateway, if any."""
+    gateway_socket = _gateway_sockets.sockets.pop(gateway, None)
+    if gateway_socket is not None:
+        gateway_socket.close()
+
+
 def get_public_address(gateway_ip=None, retry=9):
     """A high-level function that returns the public interface IP of
        the current host by querying the NAT-PMP gateway.  IP is
@@ -413,49 +585,420 @@ def map_port(protocol, public_port, private_port, lifetime=3600,
     return port_mapping_response
 
 
+def map_port_raw(protocol, public_port, private_port, lifetime=3600,
+                 gateway_ip=None, retry=9, use_exception=True):
+    """A leaner map_port() for callers refreshing many mappings.  The
+       request is packed straight to bytes without building request or
+       response objects, and the response is returned as a PortMapResult
+       named tuple.  Takes the same arguments as map_port().
+    """
+    if protocol not in (NATPMP_PROTOCOL_UDP, NATPMP_PROTOCOL_TCP):
+        raise ValueError("Must be either NATPMP_PROTOCOL_UDP or "
+                         "NATPMP_PROTOCOL_TCP")
+    if gateway_ip is None:
+        gateway_ip = get_gateway_addr()
+    request_bytes = _REQ_PORTMAP.pack(0, protocol, NATPMP_RESERVED_VAL,
+                                      private_port, public_port, lifetime)
+    data = _send_bytes_with_retry(gateway_ip, request_bytes, protocol + 128,
+                                  PortMapRequest.initial_timeout, retry=retry)
+    if len(data) < _RESP_PORTMAP.size:
+        data = data.ljust(_RESP_PORTMAP.size, b"\0")  # header-only error
+    result = PortMapResult._make(_RESP_PORTMAP.unpack_from(data))
+    if result.result != 0 and use_exception:
+        raise NATPMPResultError(result.result, error_str(result.result),
+                                result)
+    return result
+
+
+def map_ports(requests, gateway_ip=None, retry=9, use_exception=True):
+    """A function to issue several PortMapRequests to the gateway at once.
+       All requests are sent over one socket and retried together, with
+       only the still-unanswered ones retransmitted on each retry.
+       Returns the PortMapResponses in the order of requests.
+
+       Responses carry only the protocol and private port to identify
+       their request, so no two requests may share both; a ValueError is
+       raised if they do.  An error response consisting of just the 8-byte
+       header carries no port at all, so it is taken as the response to
+       every unanswered request of its protocol.
+
+            requests - an iterable of PortMapRequest objects
+            gateway_ip - the IP to the NAT-PMP compatible gateway.
+                         Defaults to using auto-detection function
+                         get_gateway_addr()
+            retry - the number of times to retry the requests if
+                    unsuccessful.  Defaults to 9 as per specification.
+            use_exception - throw an exception if an error result
+                            is received from the gateway.  Defaults to True.
+    """
+    requests = list(requests)
+    if gateway_ip is None:
+        gateway_ip = get_gateway_addr()
+    # responses are matched to requests by protocol and private port
+    pending = {}
+    for request in requests:
+        key = (request.opcode, request.private_port)
+        if key in pending:
+            raise ValueError("Duplicate request for protocol %d, private "
+                             "port %d" % key)
+        pending[key] = request.toBytes()
+    response_opcodes = set(request.opcode + 128 for request in requests)
+    responses = {}
+    gateway_socket = _get_cached_gateway_socket(gateway_ip)
+    timeout = PortMapRequest.initial_timeout
+    for _ in range(retry):
+        if not pending:
+            break
+        for request_bytes in pending.values():
+            gateway_socket.sendall(request_bytes)
+        deadline = time.monotonic() + timeout
+        remaining = timeout
+        while pending and remaining > 0:
+            data, _ = read_response(gateway_socket, remaining)
+            if data is None:
+                break
+            if _is_complete_response(data) and data[1] in response_opcodes:
+                response = PortMapResponse(data)
+                protocol = response.opcode - 128
+                if len(data) < _RESP_PORTMAP.size:
+                    keys = [key for key in pending if key[0] == protocol]
+                else:
+                    keys = [(protocol, response.private_port)]
+                for key in keys:
+                    if pending.pop(key, None) is not None:
+                        responses[key] = response
+            remaining = deadline - time.monotonic()
+        timeout *= 2
+
+    if pending:
+        _close_cached_gateway_socket(gateway_ip)
+        raise NATPMPUnsupportedError(NATPMP_GATEWAY_NO_SUPPORT,
+                                     error_str(NATPMP_GATEWAY_NO_SUPPORT))
+    port_mapping_responses = [responses[(request.opcode,
+                                         request.private_port)]
+                              for request in requests]
+    if use_exception:
+        for port_mapping_response in port_mapping_responses:
+            if port_mapping_response.result != 0:
+                raise NATPMPResultError(port_mapping_response.result,
+                                        error_str(port_mapping_response.result),
+                                        port_mapping_response)
+    return port_mapping_responses
+
+
 def send_request(gateway_socket, request):
     gateway_socket.sendall(request.toBytes())
 
 
 def read_response(gateway_socket, timeout, response_size=16):
-    data = ""
-    source_addr = ("", "")
-    rlist, wlist, xlist = select.select([gateway_socket], [], [], timeout)
-    if rlist:
-        resp_socket = rlist[0]
-        try:
-            data, source_addr = resp_socket.recvfrom(response_size)
-        except Exception:
-            return None, None
-    return data, source_addr
+    """Waits up to timeout seconds for a datagram on gateway_socket.
+       Returns a (data, source_addr) pair for compatibility, but as the
+       socket is connected to the gateway, the kernel already drops
+       datagrams from any other source and source_addr is always None.
+    """
+    data = b""
+    gateway_socket.settimeout(timeout)
+    try:
+        data = gateway_socket.recv(response_size)
+    except socket.timeout:
+        pass
+    except Exception:
+        return None, None
+    return data, None
+
+
+def _is_complete_response(data):
+    """Returns True if data holds a complete response for its opcode, or
+       False if it is truncated.  Error responses consisting of just the
+       8-byte header are complete.
+    """
+    if len(data) < _RESP_HEADER.size:
+        return False
+    if len(data) >= _RESP_SIZES.get(data[1], _RESP_HEADER.size):
+        return True
+    return _RESP_HEADER.unpack_from(data)[2] != NATPMP_RESULT_SUCCESS
+
+
+def _send_bytes_with_retry(gateway_ip, request_bytes, response_opcode,
+                          initial_timeout, retry=9, response_size=16):
+    """Sends request_bytes to gateway_ip, retransmitting up to retry times
+       with the timeout doubling after each attempt, as per specification.
+       Returns the raw bytes of the first response carrying
+       response_opcode.
+    """
+    gateway_socket = _get_cached_gateway_socket(gateway_ip)
+    timeout = initial_timeout
+    for _ in range(retry):
+        gateway_socket.sendall(request_bytes)
+        deadline = time.monotonic() + timeout
+        remaining = timeout
+        while remaining > 0:
+            data, _ = read_response(gateway_socket, remaining,
+                                    response_size=response_size)
+            if data is None:
+                break
+            # discard truncated packets and stale responses to an earlier
+            # request, but keep waiting out the current timeout
+            if _is_complete_response(data) and data[1] == response_opcode:
+                return data
+            remaining = deadline - time.monotonic()
+        timeout *= 2
+
+    _close_cached_gateway_socket(gateway_ip)
+    raise NATPMPUnsupportedError(NATPMP_GATEWAY_NO_SUPPORT,
+                                 error_str(NATPMP_GATEWAY_NO_SUPPORT))
 
 
 def send_request_with_retry(gateway_ip, request, response_data_class=None,
                             retry=9, response_size=16):
-    gateway_socket = get_gateway_socket(gateway_ip)
-    n = 1
-    timeout = request.initial_timeout
-    data = ""
-    while n <= retry and not data:
-        send_request(gateway_socket, request)
-        data, source_addr = read_response(gateway_socket,
-                                          timeout,
-                                          response_size=response_size)
-        if data is None or source_addr[0] != gateway_ip or\
-                source_addr[1] != NATPMP_PORT:
-            data = ""  # discard data if source mismatch, as per specification
-
-        n += 1
-        timeout *= 2
-
-    if n >= retry and not data:
-        raise NATPMPUnsupportedError(NATPMP_GATEWAY_NO_SUPPORT,
-                                     error_str(NATPMP_GATEWAY_NO_SUPPORT))
-    if data and response_data_class:
+    """Sends request to gateway_ip, retransmitting up to retry times
+       with the timeout doubling after each attempt (initially
+       request.initial_timeout), as per specification.
+    """
+    data = _send_bytes_with_retry(gateway_ip, request.toBytes(),
+                                  request.opcode + 128,
+                                  request.initial_timeout, retry=retry,
+                                  response_size=response_size)
+    if response_data_class:
         data = response_data_class(data)
     return data
 
 
+class _NATPMPDatagramProtocol(asyncio.DatagramProtocol):
+    """Datagram protocol for one request/response exchange with a gateway.
+       The response future resolves to the response bytes, or to None if
+       a network error was reported on the endpoint.
+    """
+    def __init__(self, request, loop):
+        self.request_bytes = request.toBytes()
+        self.response_opcode = request.opcode + 128
+        self.loop = loop
+        self.transport = None
+        self.response = loop.create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def send(self):
+        if self.response.done():
+            self.response = self.loop.create_future()
+        self.transport.sendto(self.request_bytes)
+
+    def datagram_received(self, data, addr):
+        # the endpoint is connected to the gateway, so only truncated
+        # packets and stale responses to an earlier request are discarded
+        if self.response.done() or len(data) < _RESP_HEADER.size or\
+                data[1] != self.response_opcode or\
+                not _is_complete_response(data):
+            return
+        self.response.set_result(data)
+
+    def error_received(self, exc):
+        if not self.response.done():
+            self.response.set_result(None)
+
+
+async def send_request_with_retry_async(gateway_ip, request,
+                                        response_data_class=None, retry=9,
+                                        response_size=16):
+    """Coroutine version of send_request_with_retry(), allowing many
+       requests to be in flight from one thread.  Each request is sent
+       from its own datagram endpoint with the same doubling timeout.
+    """
+    if not gateway_ip:
+        raise NATPMPNetworkError(NATPMP_GATEWAY_NO_VALID_GATEWAY,
+                                 error_str(NATPMP_GATEWAY_NO_VALID_GATEWAY))
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: _NATPMPDatagramProtocol(request, loop),
+        remote_addr=(gateway_ip, NATPMP_PORT))
+    try:
+        timeout = request.initial_timeout
+        for _ in range(retry):
+            protocol.send()
+            # asyncio.wait() does not cancel the future on timeout, so a
+            # late response to an earlier transmission is still accepted
+            await asyncio.wait([protocol.response], timeout=timeout)
+            if protocol.response.done():
+                data = protocol.response.result()
+                if data is not None:
+                    data = data[:response_size]
+                    if response_data_class:
+                        data = response_data_class(data)
+                    return data
+            timeout *= 2
+    finally:
+        transport.close()
+    raise NATPMPUnsupportedError(NATPMP_GATEWAY_NO_SUPPORT,
+                                 error_str(NATPMP_GATEWAY_NO_SUPPORT))
+
+
+class AddressChangeListener(object):
+    """Listens in a background daemon thread for the public address change
+       announcements a NAT-PMP gateway multicasts to NATPMP_MULTICAST_ADDR
+       on NATPMP_CLIENT_PORT, and calls each registered callback with the
+       announcement as a PublicAddressResponse.  Callbacks run on the
+       listener thread; an exception raised by one is printed to stderr
+       and does not stop the listener or the other callbacks.
+
+       The listener can also keep port mappings alive: mappings added with
+       add_mapping() are renewed at half their granted lifetime (but at
+       most every min_renew_interval seconds), and immediately whenever an
+       announcement arrives.
+
+       e.g. listener = AddressChangeListener('10.0.1.1')
+            listener.register(lambda response: print(response.ip))
+            listener.start()
+    """
+    poll_interval = 1.0  # seconds between checks for stop()
+    renew_retry_interval = 60.0  # seconds before retrying a failed renewal
+    min_renew_interval = 10.0  # seconds, however short the granted lifetime
+    # attempts per renewal (about 4 seconds), so that an unreachable
+    # gateway does not keep the thread from announcements or stop()
+    renew_retry = 4
+
+    def __init__(self, gateway_ip=None):
+        if gateway_ip is None:
+            gateway_ip = get_gateway_addr()
+        self.gateway_ip = gateway_ip
+        self._callbacks = []
+        # (protocol, private_port) -> [public_port, lifetime, renew_at]
+        self._mappings = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._socket = None
+        self._thread = None
+
+    def register(self, callback):
+        """Calls callback(response) for every address change announcement."""
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def unregister(self, callback):
+        with self._lock:
+            self._callbacks.remove(callback)
+
+    def add_mapping(self, protocol, public_port, private_port, lifetime=3600):
+        """Maps the port as map_port() does, then keeps renewing the
+           mapping from the listener thread.  Returns the response.
+
+           A lifetime of 0 deletes the mapping instead, as per
+           specification, and stops renewing it.
+        """
+        if lifetime == 0:
+            self.remove_mapping(protocol, private_port)
+            return map_port(protocol, public_port, private_port, 0,
+                            gateway_ip=self.gateway_ip)
+        response = map_port(protocol, public_port, private_port, lifetime,
+                            gateway_ip=self.gateway_ip)
+        renew_at = time.monotonic() + self._renew_interval(response.lifetime)
+        with self._lock:
+            self._mappings[(protocol, private_port)] = [public_port, lifetime,
+                                                       renew_at]
+        return response
+
+    def remove_mapping(self, protocol, private_port):
+        """Stops renewing a mapping; it expires with its current lifetime."""
+        with self._lock:
+            self._mappings.pop((protocol, private_port), None)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        listen_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listen_socket.bind(("", NATPMP_CLIENT_PORT))
+        try:
+            listen_socket.setsockopt(socket.IPPROTO_IP,
+                                     socket.IP_ADD_MEMBERSHIP,
+                                     socket.inet_aton(NATPMP_MULTICAST_ADDR) +
+                                     socket.inet_aton("0.0.0.0"))
+        except socket.error:
+            pass  # already a member of the all-hosts group
+        # the socket must stay unconnected: connecting it would rebind it to
+        # a unicast address and it would no longer receive the multicast
+        self._socket = listen_socket
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name="AddressChangeListener")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self._socket.close()
+        self._socket = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            timeout = self._renew_due_mappings()
+            self._socket.settimeout(timeout)
+            try:
+                data, source_addr = self._socket.recvfrom(_RESP_ADDR.size)
+            except (socket.timeout, BlockingIOError):
+                continue
+            except OSError:
+                # a network error was reported, wait before reading again
+                self._stop.wait(timeout)
+                continue
+            # only accept announcements sent by the gateway, as per
+            # specification
+            if source_addr != (self.gateway_ip, NATPMP_PORT):
+                continue
+            if len(data) >= _RESP_ADDR.size and data[1] == 128:
+                self._dispatch(PublicAddressResponse(data))
+
+    def _dispatch(self, response):
+        with self._lock:
+            callbacks = list(self._callbacks)
+            # the gateway may have lost its mappings, so renew them now
+            for mapping in self._mappings.values():
+                mapping[2] = 0
+        for callback in callbacks:
+            try:
+                callback(response)
+            except Exception:
+                traceback.print_exc()
+
+    def _renew_interval(self, lifetime):
+        return max(lifetime / 2.0, self.min_renew_interval)
+
+    def _renew_due_mappings(self):
+        """Renews the mappings that are due and returns how long to wait
+           before the next renewal, capped at poll_interval.
+        """
+        with self._lock:
+            now = time.monotonic()
+            due = [(key, mapping[0], mapping[1])
+                   for key, mapping in self._mappings.items()
+                   if mapping[2] <= now]
+        for (protocol, private_port), public_port, lifetime in due:
+            if self._stop.is_set():
+                break
+            try:
+                response = map_port(protocol, public_port, private_port,
+                                    lifetime, gateway_ip=self.gateway_ip,
+                                    retry=self.renew_retry)
+                renew_in = self._renew_interval(response.lifetime)
+            except (NATPMPError, OSError):
+                renew_in = self.renew_retry_interval
+            with self._lock:
+                mapping = self._mappings.get((protocol, private_port))
+                if mapping is not None:
+                    mapping[2] = time.monotonic() + renew_in
+        with self._lock:
+            next_renewal = min([mapping[2] for mapping in
+                                self._mappings.values()] or [float("inf")])
+        return max(0, min(next_renewal - time.monotonic(),
+                          self.poll_interval))
+
+
 class NatPMP:
     def __init__(self, interface="default"):
         self.interface = interface
@@ -486,7 +1029,7 @@ if __name__ == "__main__":
     addr = get_public_address()
     map_resp = map_tcp_port(62001, 62001)
     print (addr)
-    print (map_resp.__dict__)
+    print (map_resp)
 
     #xxxxxx = NatPMP()
     #print(xxxxxx.forward_port("TCP", 12156, "192.168.0.4"))
@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 # Yiming Liu
 # A NAT-PMP client implementation using NATPMP.py 
-from __future__ import print_function
 
 import getopt, sys
 try:
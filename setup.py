@@ -15,6 +15,7 @@ setup(name='py-natpmp',
       packages=find_packages(exclude=['ez_setup', 'examples', 'tests']),
       include_package_data=True,
       zip_safe=True,
+      python_requires='>=3.7',
       install_requires=[
           
       ],
@@ -31,10 +32,9 @@ setup(name='py-natpmp',
     # Pick your license as you wish (should match "license" above)
      'License :: OSI Approved :: BSD License',
 
-    # Specify the Python versions you support here. In particular, ensure
-    # that you indicate whether you support Python 2, Python 3 or both.
+    # Specify the Python versions you support here.
     'Programming Language :: Python :: 3',
-    'Programming Language :: Python :: 2.7',
+    'Programming Language :: Python :: 3 :: Only',
     'Topic :: System :: Networking',
     ],
       entry_points={'console_scripts': [
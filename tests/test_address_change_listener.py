@@ -0,0 +1,111 @@
+import socket
+import struct
+import threading
+import time
+import unittest
+
+from natpmp import NATPMP
+from test_requests import FakeGateway
+
+
+class AddressChangeListenerTest(unittest.TestCase):
+    """Sends announcements over loopback multicast, posing as a gateway
+       at 127.0.0.1.
+    """
+    gateway_ip = "127.0.0.1"
+
+    def setUp(self):
+        self.listener = NATPMP.AddressChangeListener(self.gateway_ip)
+        self.listener.poll_interval = 0.1
+        self.listener.start()
+        self.addCleanup(self.listener.stop)
+
+    def announce(self, ip_int, source_port=NATPMP.NATPMP_PORT):
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(sender.close)
+        sender.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                          socket.inet_aton(self.gateway_ip))
+        sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        sender.bind((self.gateway_ip, source_port))
+        sender.sendto(struct.pack("!BBHII", 0, 128, 0, 1, ip_int),
+                      (NATPMP.NATPMP_MULTICAST_ADDR,
+                       NATPMP.NATPMP_CLIENT_PORT))
+
+    def register_event(self):
+        received = []
+        event = threading.Event()
+
+        def callback(response):
+            received.append(response)
+            event.set()
+        self.listener.register(callback)
+        return received, event
+
+    def test_callback_receives_multicast_announcement(self):
+        received, event = self.register_event()
+        self.announce(0x0a000001)
+        self.assertTrue(event.wait(2))
+        self.assertEqual(received[0].ip, "10.0.0.1")
+
+    def test_announcement_from_other_source_is_ignored(self):
+        received, event = self.register_event()
+        self.announce(0x0a000001, source_port=0)
+        self.assertFalse(event.wait(0.5))
+        self.assertEqual(received, [])
+
+    def test_raising_callback_does_not_stop_listener(self):
+        def failing_callback(response):
+            raise RuntimeError("callback failure")
+        self.listener.register(failing_callback)
+        received, event = self.register_event()
+        self.announce(0x0a000001)
+        self.assertTrue(event.wait(2))
+        event.clear()
+        self.announce(0x0a000002)
+        self.assertTrue(event.wait(2))
+        self.assertEqual([r.ip for r in received], ["10.0.0.1", "10.0.0.2"])
+
+
+class MappingRenewalTest(unittest.TestCase):
+    def setUp(self):
+        self.gateway = FakeGateway()
+        self.addCleanup(self.gateway.close)
+        self.listener = NATPMP.AddressChangeListener(self.gateway.ip)
+        self.listener.poll_interval = 0.1
+
+    def start_listener(self):
+        self.listener.start()
+        self.addCleanup(self.listener.stop)
+
+    def test_zero_lifetime_deletes_mapping(self):
+        self.start_listener()
+        self.listener.add_mapping(NATPMP.NATPMP_PROTOCOL_TCP, 80, 80, 3600)
+        response = self.listener.add_mapping(NATPMP.NATPMP_PROTOCOL_TCP,
+                                             80, 80, lifetime=0)
+        self.assertEqual(response.lifetime, 0)
+        time.sleep(0.5)
+        self.assertEqual(len(self.gateway.requests), 2)
+
+    def test_short_lifetime_renewal_is_rate_limited(self):
+        self.start_listener()
+        self.listener.add_mapping(NATPMP.NATPMP_PROTOCOL_TCP, 80, 80,
+                                  lifetime=1)
+        time.sleep(1)
+        self.assertEqual(len(self.gateway.requests), 1)
+
+    def test_stop_with_unresponsive_gateway(self):
+        self.listener.min_renew_interval = 0.1
+        self.listener.add_mapping(NATPMP.NATPMP_PROTOCOL_TCP, 80, 80,
+                                  lifetime=1)
+        self.gateway.silent = True
+        self.listener.start()
+        time.sleep(1)  # the first renewal is now waiting on the gateway
+        started = time.monotonic()
+        self.listener.stop()
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertGreater(len(self.gateway.requests), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+import asyncio
+import socket
+import struct
+import threading
+import unittest
+
+from natpmp import NATPMP
+
+
+class FakeGateway(object):
+    """Answers NAT-PMP requests on 127.0.0.1:NATPMP_PORT.  If error_result
+       is set, every request gets a header-only error response with it.
+       Requests are recorded but not answered while silent is set.
+    """
+    ip = "127.0.0.1"
+
+    def __init__(self, error_result=None):
+        self.error_result = error_result
+        self.silent = False
+        self.requests = []
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.ip, NATPMP.NATPMP_PORT))
+        self.socket.settimeout(0.1)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.socket.close()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                data, addr = self.socket.recvfrom(64)
+            except socket.timeout:
+                continue
+            self.requests.append(data)
+            if self.silent:
+                continue
+            self.socket.sendto(self.respond(data), addr)
+
+    def respond(self, data):
+        opcode = data[1]
+        if self.error_result is not None:
+            return struct.pack("!BBHI", 0, opcode + 128, self.error_result, 1)
+        if opcode == 0:
+            return struct.pack("!BBHII", 0, 128, 0, 1, 0x0a000001)
+        _, _, _, private_port, public_port, lifetime = \
+            struct.unpack("!BBHHHI", data)
+        return struct.pack("!BBHIHHI", 0, opcode + 128, 0, 1, private_port,
+                           public_port, lifetime)
+
+
+class RequestTest(unittest.TestCase):
+    def start_gateway(self, error_result=None):
+        gateway = FakeGateway(error_result)
+        self.addCleanup(gateway.close)
+        return gateway
+
+    def test_public_address(self):
+        gateway = self.start_gateway()
+        self.assertEqual(NATPMP.get_public_address(gateway.ip), "10.0.0.1")
+
+    def test_public_address_response_with_default_size(self):
+        gateway = self.start_gateway()
+        response = NATPMP.send_request_with_retry(
+            gateway.ip, NATPMP.PublicAddressRequest(),
+            response_data_class=NATPMP.PublicAddressResponse, retry=3)
+        self.assertEqual(response.ip, "10.0.0.1")
+
+    def test_public_address_response_async_with_default_size(self):
+        gateway = self.start_gateway()
+        response = asyncio.run(NATPMP.send_request_with_retry_async(
+            gateway.ip, NATPMP.PublicAddressRequest(),
+            response_data_class=NATPMP.PublicAddressResponse, retry=3))
+        self.assertEqual(response.ip, "10.0.0.1")
+
+    def test_map_port(self):
+        gateway = self.start_gateway()
+        response = NATPMP.map_tcp_port(8080, 80, gateway_ip=gateway.ip)
+        self.assertEqual((response.private_port, response.public_port),
+                         (80, 8080))
+        result = NATPMP.map_port_raw(NATPMP.NATPMP_PROTOCOL_UDP, 9090, 90,
+                                     gateway_ip=gateway.ip)
+        self.assertEqual((result.private_port, result.public_port), (90, 9090))
+
+    def test_map_ports(self):
+        gateway = self.start_gateway()
+        requests = [NATPMP.PortMapRequest(NATPMP.NATPMP_PROTOCOL_TCP, 80, 8080),
+                    NATPMP.PortMapRequest(NATPMP.NATPMP_PROTOCOL_UDP, 80, 8081),
+                    NATPMP.PortMapRequest(NATPMP.NATPMP_PROTOCOL_TCP, 81, 8082)]
+        responses = NATPMP.map_ports(requests, gateway_ip=gateway.ip)
+        self.assertEqual([r.public_port for r in responses], [8080, 8081, 8082])
+
+    def test_header_only_error_raises_result_error(self):
+        gateway = self.start_gateway(NATPMP.NATPMP_RESULT_UNSUPPORTED_VERSION)
+        for call in (lambda: NATPMP.get_public_address(gateway.ip),
+                     lambda: NATPMP.map_tcp_port(80, 80, gateway_ip=gateway.ip),
+                     lambda: NATPMP.map_port_raw(NATPMP.NATPMP_PROTOCOL_TCP,
+                                                 80, 80,
+                                                 gateway_ip=gateway.ip),
+                     lambda: NATPMP.map_ports(
+                         [NATPMP.PortMapRequest(NATPMP.NATPMP_PROTOCOL_TCP,
+                                                80, 80)],
+                         gateway_ip=gateway.ip)):
+            with self.assertRaises(NATPMP.NATPMPResultError) as context:
+                call()
+            self.assertEqual(context.exception.args[0],
+                             NATPMP.NATPMP_RESULT_UNSUPPORTED_VERSION)
+
+    def test_header_only_error_without_exception(self):
+        gateway = self.start_gateway(NATPMP.NATPMP_RESULT_NOT_AUTHORIZED)
+        response = NATPMP.map_tcp_port(80, 80, gateway_ip=gateway.ip,
+                                       use_exception=False)
+        self.assertEqual(response.result, NATPMP.NATPMP_RESULT_NOT_AUTHORIZED)
+        requests = [NATPMP.PortMapRequest(NATPMP.NATPMP_PROTOCOL_TCP, 80, 80),
+                    NATPMP.PortMapRequest(NATPMP.NATPMP_PROTOCOL_UDP, 80, 80)]
+        responses = NATPMP.map_ports(requests, gateway_ip=gateway.ip,
+                                     use_exception=False)
+        self.assertEqual([r.result for r in responses],
+                         [NATPMP.NATPMP_RESULT_NOT_AUTHORIZED] * 2)
+
+
+if __name__ == "__main__":
+    unittest.main()